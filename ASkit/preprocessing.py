@@ -1,9 +1,14 @@
+import tempfile
+from contextlib import ExitStack
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import polars as pl
 
+_RESOURCES = Path(__file__).parent / "resources"
+
 
 def create_phenotypes(
     code_file: str,
@@ -50,7 +55,8 @@ def create_phenotypes(
         perform the mapping in 3 batches of subjects. The output of each batch will be
         appended to ``outfile``. Only .csv output is supported.
     outfile
-        Output path for saving the phenotype file.
+        Output path for saving the phenotype file, as .csv, .parquet, or .feather/.ipc.
+        The columnar formats are much faster to write and read back than .csv.
 
     Returns
     -------
@@ -72,51 +78,79 @@ def create_phenotypes(
         raise NotImplementedError(
             "Only .csv output is supported for chunked PheCode mapping."
         )
-    if outfile and Path(outfile).is_file():
-        Path(outfile).unlink()
-
-    with pl.StringCache():
-        cohort_codes = _get_cohort_codes(
-            code_file, map_phecodes, phecode_rollup, phecode_exclude
-        )
-
-        if n_chunks > 1:
-            cohort_ids = (
-                _read_file(code_file)
-                .select("PT_ID")
+    if outfile:
+        Path(outfile).unlink(missing_ok=True)
+
+    with pl.StringCache(), ExitStack() as stack:
+        if n_chunks > 1 or sex:
+            # restrict the resource maps to the codes seen in the cohort once,
+            # instead of scanning and joining the full maps for every chunk
+            unique_codes = (
+                _read_file(code_file, columns=["code"])
+                .select(pl.col("code").cast(pl.Categorical))
                 .unique()
-                .with_column(pl.col("PT_ID").cast(pl.Categorical))
-                .collect()["PT_ID"]
             )
+            if n_chunks > 1:
+                cohort_ids = (
+                    _read_file(code_file, columns=["PT_ID"])
+                    .unique()
+                    .with_column(pl.col("PT_ID").cast(pl.Categorical))
+                )
+                # both probes scan the code file, so run them as one batch
+                unique_codes, cohort_ids = pl.collect_all([unique_codes, cohort_ids])
+                cohort_ids = cohort_ids["PT_ID"]
+            else:
+                unique_codes = unique_codes.collect()
+            phemap, rollup_map, exclusions, cohort_codes = _restrict_to_cohort(
+                unique_codes,
+                phemap=_scan_phecode_map() if map_phecodes else None,
+                rollup_map=_scan_rollup_map() if phecode_rollup else None,
+                exclusions=_scan_exclusions() if phecode_exclude else None,
+            )
+        else:
+            # single pass over the cohort, the maps are only joined once anyway
+            phemap = _scan_phecode_map()
+            rollup_map = _scan_rollup_map()
+            exclusions = _scan_exclusions()
+            cohort_codes = None
+        sex_restrictions = _scan_sex_restrictions()
 
+        if n_chunks > 1:
             if n_chunks > cohort_ids.shape[0]:
                 raise ValueError("n_chunks is greater than number of subjects")
             chunks = np.array_split(np.arange(cohort_ids.shape[0]), n_chunks)
+
+            # split the code file by chunk once, so each chunk only reads its own
+            # subjects instead of scanning the whole file; the partitions are removed
+            # when the with block exits, even if a chunk fails
+            partition_dir = stack.enter_context(
+                tempfile.TemporaryDirectory(dir=Path(outfile).parent)
+            )
+            chunk_files = _partition_code_file(
+                code_file, cohort_ids, chunks, partition_dir
+            )
         else:
             chunks = range(1)
+            chunk_files = [code_file]
             chunk_ids = None
 
-        for chunk in chunks:
-            codes = _read_file(code_file)
+        for chunk, chunk_file in zip(chunks, chunk_files):
+            if n_chunks > 1:
+                chunk_ids = cohort_ids.take(chunk)
+
+            codes = _read_file(chunk_file, columns=["PT_ID", "code", "index"])
             codes = codes.with_columns(
                 [
                     pl.col("PT_ID").cast(pl.Categorical),
                     pl.col("code").cast(pl.Categorical),
                 ]
             )
-            if n_chunks > 1:
-                chunk_ids = cohort_ids.take(chunk)
-
-                # https://github.com/pola-rs/polars/issues/3420
-                # codes = codes.filter(pl.col("PT_ID").is_in(chunk_ids))
-                # workaround join
-                codes = codes.join(chunk_ids.to_frame().lazy(), how="inner", on="PT_ID")
 
             if map_phecodes:
-                codes = map_icd_to_phecodes(codes)
+                codes = map_icd_to_phecodes(codes, phemap)
 
             if phecode_rollup:
-                codes = map_rollup(codes)
+                codes = map_rollup(codes, rollup_map)
 
             codes = (
                 codes.groupby(["PT_ID", "code"])
@@ -125,45 +159,42 @@ def create_phenotypes(
             )
 
             if phecode_exclude:
-                codes = map_exclusions(codes)
+                codes = map_exclusions(codes, exclusions)
 
             if sex:
-                codes = map_sex_restrictions(codes, sex, cohort_codes, chunk_ids)
-
-            codes = (
-                codes.groupby(["PT_ID", "code"])
-                .agg(pl.max("count"))
-                .select(
-                    [
-                        "PT_ID",
-                        "code",
-                        pl.when(pl.col("count") < min_code_count)
-                        .then(-9)
-                        .otherwise(1)
-                        .cast(pl.Int16)
-                        .alias("count"),
-                    ]
+                codes = map_sex_restrictions(
+                    codes, sex, cohort_codes, chunk_ids, sex_restrictions
                 )
+
+            # exclusions and sex restrictions keep one row per id and code, so no
+            # second aggregation is needed here
+            codes = codes.select(
+                [
+                    "PT_ID",
+                    "code",
+                    pl.when(pl.col("count") < min_code_count)
+                    .then(-9)
+                    .otherwise(1)
+                    .cast(pl.Int16)
+                    .alias("count"),
+                ]
             )
 
+            # collect before padding, the anti join and concat would otherwise each
+            # re-run the whole chunk plan
+            codes = codes.collect()
             if n_chunks > 1:
                 codes = _add_missing_codes(codes, cohort_codes, chunk_ids)
-            codes = codes.collect()
-
-            # polars pivot takes uses a LOT more ram
-            codes = codes.to_pandas()
-            codes = codes.pivot(
-                index="PT_ID", columns="code", values="count"
-            ).rename_axis(None, axis=1)
-            codes = codes.fillna(0)
-            codes = codes[sorted(codes.columns.tolist())].reset_index()
+            codes = _pivot_codes(codes)
             if outfile:
                 _pd_write_file(output=codes, filename=outfile, n_chunks=n_chunks)
 
     return codes
 
 
-def map_icd_to_phecodes(codes: pl.LazyFrame) -> pl.LazyFrame:
+def map_icd_to_phecodes(
+    codes: pl.LazyFrame, phemap: pl.LazyFrame = None
+) -> pl.LazyFrame:
     """
     Map ICD9 and/or ICD10 codes to PheCodes. The v1.2b1 mapping from the R package is
     used, from ``PheWAS::phecode_map``.
@@ -172,19 +203,16 @@ def map_icd_to_phecodes(codes: pl.LazyFrame) -> pl.LazyFrame:
     ----------
     codes
         pl.LazyFrame of ``PT_ID, code, index``
+    phemap
+        Pre-loaded PheCode map of categorical ``code, phecode``, e.g. restricted to
+        the codes seen in the cohort. Read from the package resources if not supplied.
     Returns
     -------
         pl.LazyFrame
             of ``PT_ID, code, index``, where codes are now PheCodes
     """
-    phemap = pl.scan_parquet("resources/phecode_map.parquet")  # PheWAS::phecode_map
-
-    phemap = phemap.with_columns(
-        [
-            pl.col("code").cast(pl.Categorical),
-            pl.col("phecode").cast(pl.Categorical),
-        ]
-    )
+    if phemap is None:
+        phemap = _scan_phecode_map()
 
     codes = (
         codes.join(phemap, on=["code"], how="inner")
@@ -194,7 +222,7 @@ def map_icd_to_phecodes(codes: pl.LazyFrame) -> pl.LazyFrame:
     return codes
 
 
-def map_rollup(codes: pl.LazyFrame) -> pl.LazyFrame:
+def map_rollup(codes: pl.LazyFrame, rollup_map: pl.LazyFrame = None) -> pl.LazyFrame:
     """
     Perform roll-up of PheCodes, mapping each PheCode to its parent codes.
     Uses the ``PheWAS::phecode_rollup_map`` from the R package.
@@ -203,21 +231,16 @@ def map_rollup(codes: pl.LazyFrame) -> pl.LazyFrame:
     ----------
     codes
         pl.LazyFrame of ``PT_ID, code, index``
+    rollup_map
+        Pre-loaded roll-up map of categorical ``code, phecode_unrolled``. Read from
+        the package resources if not supplied.
     Returns
     -------
         pl.LazyFrame
             of ``PT_ID, code, index``
     """
-    rollup_map = pl.scan_parquet(
-        "resources/phecode_rollup_map.parquet"  # PheWAS::phecode_rollup_map
-    )
-
-    rollup_map = rollup_map.with_columns(
-        [
-            pl.col("code").cast(pl.Categorical),
-            pl.col("phecode_unrolled").cast(pl.Categorical),
-        ]
-    )
+    if rollup_map is None:
+        rollup_map = _scan_rollup_map()
 
     codes = (
         codes.join(rollup_map, on="code", how="inner")
@@ -227,7 +250,9 @@ def map_rollup(codes: pl.LazyFrame) -> pl.LazyFrame:
     return codes
 
 
-def map_exclusions(codes: pl.LazyFrame) -> pl.LazyFrame:
+def map_exclusions(
+    codes: pl.LazyFrame, exclusions: pl.LazyFrame = None
+) -> pl.LazyFrame:
     """
     Apply PheCode exclusion criteria. Uses ``PheWAS::phecode_exclude`` from the R pkg.
 
@@ -235,36 +260,40 @@ def map_exclusions(codes: pl.LazyFrame) -> pl.LazyFrame:
     ----------
     codes
         pl.LazyFrame of ``PT_ID, code, index``
+    exclusions
+        Pre-loaded exclusion map of categorical ``code, exclusion_criteria``. Read
+        from the package resources if not supplied.
     Returns
     -------
         pl.LazyFrame
             of ``PT_ID, code, index``
     """
-    exclusions = pl.scan_parquet(
-        "resources/phecode_exclude.parquet"  # PheWAS::phecode_exclude)
-    )
+    if exclusions is None:
+        exclusions = _scan_exclusions()
 
-    exclusions = exclusions.with_columns(
-        [
-            pl.col("code").cast(pl.Categorical),
-            pl.col("exclusion_criteria").cast(pl.Categorical),
-        ]
-    )
     exclusions = (
         exclusions.join(
             codes.select(["PT_ID", pl.col("code").alias("exclusion_criteria")]),
             how="inner",
             on="exclusion_criteria",
         )
-        .select(["PT_ID", "code", pl.lit(-9).alias("count").cast(pl.Int16)])
+        .select(["PT_ID", "code"])
         .unique()
     )
-    codes = pl.concat([codes, exclusions])
+    # keep one row per id and code: observed codes keep their count, codes only
+    # reached through an exclusion criterion are marked -9
+    codes = codes.join(exclusions, how="outer", on=["PT_ID", "code"]).with_column(
+        pl.col("count").fill_null(-9).cast(pl.Int16)
+    )
     return codes
 
 
 def map_sex_restrictions(
-    codes: pl.LazyFrame, sex: str, cohort_codes: pl.DataFrame, chunk_ids: pl.Series
+    codes: pl.LazyFrame,
+    sex: str,
+    cohort_codes: pl.DataFrame,
+    chunk_ids: pl.Series,
+    sex_restrictions: pl.LazyFrame = None,
 ) -> pl.LazyFrame:
     """
     Apply PheCode sex restrictions. Uses ``PheWAS::gender_restriction`` from the R pkg.
@@ -276,11 +305,21 @@ def map_sex_restrictions(
         Path to a csv, parquet, or feather/IPC file containing columns ``PT_ID, sex``,
         where sex is provided as ``Male`` or ``Female``. If supplied, sex-based PheCode
         restrictions will be applied.
+    cohort_codes
+        pl.DataFrame of all codes seen in cohort, including mapped exclusions.
+    chunk_ids
+        All subject ids in the current chunk, or None if not chunked.
+    sex_restrictions
+        Pre-loaded restriction map of categorical ``code, exclude_sex``. Read from the
+        package resources if not supplied.
     Returns
     -------
         pl.LazyFrame
             of ``PT_ID, code, index``
     """
+    if sex_restrictions is None:
+        sex_restrictions = _scan_sex_restrictions()
+
     sex = _read_file(sex, columns=["PT_ID", "sex"])
     sex = sex.select(
         [
@@ -290,30 +329,28 @@ def map_sex_restrictions(
     )
     if chunk_ids:
         sex = sex.join(chunk_ids.to_frame().lazy(), how="inner", on="PT_ID")
-
-    sex_restrictions = pl.scan_parquet(
-        "resources/sex_restriction.parquet"  # PheWAS::gender_restriction
-    ).with_columns(
-        [
-            pl.col("code").cast(pl.Categorical),
-            pl.col("exclude_sex").cast(pl.Categorical),
-        ]
-    )
+    # sex is joined on two branches below, materialize it so projection pushdown
+    # can't prune the ``sex`` column from the shared scan
+    sex = sex.collect().lazy()
 
     # only keep codes that are observed in cohort
+    sex_restrictions = sex_restrictions.join(cohort_codes.lazy(), how="semi", on="code")
+
+    # codes restricted to the opposite sex of each id
     sex_restrictions = sex_restrictions.join(
-        cohort_codes.lazy(), how="inner", on="code"
-    )
+        sex, how="inner", left_on="exclude_sex", right_on="sex"
+    ).select(["PT_ID", "code", pl.lit(True).alias("restricted")])
 
-    # change existing codes that are inconsistent with id's sex
+    # change existing codes that are inconsistent with id's sex, and add the
+    # remaining restricted codes as exclusions so they're not considered as controls
     codes = (
-        codes.join(sex, how="inner", on="PT_ID")
-        .join(sex_restrictions, how="left", on="code")
+        codes.join(sex.select("PT_ID"), how="semi", on="PT_ID")
+        .join(sex_restrictions, how="outer", on=["PT_ID", "code"])
         .select(
             [
                 "PT_ID",
                 "code",
-                pl.when(pl.col("sex") == pl.col("exclude_sex"))
+                pl.when(pl.col("restricted"))
                 .then(-9)
                 .otherwise(pl.col("count"))
                 .cast(pl.Int16)
@@ -321,101 +358,72 @@ def map_sex_restrictions(
             ]
         )
     )
-
-    # add exclusions so they're not considered as controls
-    sex_restrictions = sex_restrictions.join(
-        sex, how="inner", left_on="exclude_sex", right_on="sex"
-    ).select(["PT_ID", "code", pl.lit(-9).cast(pl.Int16).alias("count")])
-
-    return pl.concat([codes, sex_restrictions])
+    return codes
 
 
-def _get_cohort_codes(
-    code_file: str,
-    map_phecodes: bool = True,
-    phecode_rollup: bool = True,
-    phecode_exclude: bool = True,
-):
+def _restrict_to_cohort(
+    unique_codes: pl.DataFrame,
+    phemap: pl.LazyFrame = None,
+    rollup_map: pl.LazyFrame = None,
+    exclusions: pl.LazyFrame = None,
+) -> tuple:
     """
-    Get all unique PheCodes seen in cohort, starting from ICD codes.
+    Restrict the resource maps to the codes seen in cohort, and get all unique codes
+    the cohort maps to. Each map is restricted to the output of the previous step, in
+    the same order as the mapping in ``create_phenotypes``.
 
     Parameters
     ----------
-    code_file
-        ICD code file with columns ``id, ICD, index``.
-    map_phecodes
-    phecode_rollup
-    phecode_exclude
+    unique_codes
+        pl.DataFrame of the distinct codes in the code file.
+    phemap
+        PheCode map, or None to skip PheCode mapping.
+    rollup_map
+        Roll-up map, or None to skip roll-up.
+    exclusions
+        Exclusion map, or None to skip exclusions.
 
     Returns
     -------
-    pl.DataFrame
+    tuple
+        ``(phemap, rollup_map, exclusions, cohort_codes)``, where each map is a
+        materialized pl.LazyFrame (or None if skipped) and ``cohort_codes`` is a
+        pl.DataFrame of all codes seen in cohort, including mapped exclusions.
     """
-    codes = (
-        _read_file(code_file)
-        .select("code")
-        .with_column(pl.col("code").cast(pl.Categorical))
-    )
+    codes = unique_codes
 
-    if map_phecodes:
-        phemap = pl.scan_parquet("resources/phecode_map.parquet")  # PheWAS::phecode_map
-        phemap = phemap.with_columns(
-            [
-                pl.col("code").cast(pl.Categorical),
-                pl.col("phecode").cast(pl.Categorical),
-            ]
-        )
+    if phemap is not None:
+        phemap = phemap.join(codes.lazy(), how="semi", on="code").collect().lazy()
+        codes = phemap.select(pl.col("phecode").alias("code")).unique().collect()
 
+    if rollup_map is not None:
+        rollup_map = (
+            rollup_map.join(codes.lazy(), how="semi", on="code").collect().lazy()
+        )
         codes = (
-            codes.join(phemap, on=["code"], how="inner")
-            .select(pl.col("phecode").alias("code"))
+            rollup_map.select(pl.col("phecode_unrolled").alias("code"))
             .unique()
+            .collect()
         )
 
-        if phecode_rollup:
-            rollup_map = pl.scan_parquet(
-                "resources/phecode_rollup_map.parquet"  # PheWAS::phecode_rollup_map
+    if exclusions is not None:
+        exclusions = (
+            exclusions.join(
+                codes.lazy().select(pl.col("code").alias("exclusion_criteria")),
+                how="semi",
+                on="exclusion_criteria",
             )
+            .collect()
+            .lazy()
+        )
+        codes = pl.concat([codes, exclusions.select("code").collect()]).unique()
 
-            rollup_map = rollup_map.with_columns(
-                [
-                    pl.col("code").cast(pl.Categorical),
-                    pl.col("phecode_unrolled").cast(pl.Categorical),
-                ]
-            )
-
-            codes = codes.join(rollup_map, how="inner", on="code").select(
-                pl.col("phecode_unrolled").alias("code")
-            )
-
-        if phecode_exclude:
-            exclusions = pl.scan_parquet(
-                "resources/phecode_exclude.parquet"  # PheWAS::phecode_exclude)
-            )
-
-            exclusions = exclusions.with_columns(
-                [
-                    pl.col("code").cast(pl.Categorical),
-                    pl.col("exclusion_criteria").cast(pl.Categorical),
-                ]
-            )
-            exclusions = (
-                exclusions.join(
-                    codes.select(pl.col("code").alias("exclusion_criteria")),
-                    how="inner",
-                    on="exclusion_criteria",
-                )
-                .select("code")
-                .unique()
-            )
-            codes = pl.concat([codes, exclusions])
-
-        return codes.unique().collect()
+    return phemap, rollup_map, exclusions, codes
 
 
 def _add_missing_codes(
-    codes: pl.LazyFrame, cohort_codes: pl.DataFrame, chunk_ids: pl.Series
-) -> pl.LazyFrame:
+    codes: pl.DataFrame, cohort_codes: pl.DataFrame, chunk_ids: pl.Series
+) -> pl.DataFrame:
     """
     Add PheCodes seen in the cohort that are not in the current chunk of subjects. This
     allows for appending the mapping output in batches.
@@ -423,32 +431,172 @@ def _add_missing_codes(
     Parameters
     ----------
     codes
-        pl.LazyFrame of current chunk ``'PT_ID','code','count'``
+        pl.DataFrame of current chunk ``'PT_ID','code','count'``
     cohort_codes
         pl.DataFrame of all codes seen in cohort, including mapped exclusions.
     chunk_ids
         All subject ids in the current chunk
     Returns
     -------
-    pl.LazyFrame
+    pl.DataFrame
     """
+    # anti join rather than is_in, see https://github.com/pola-rs/polars/issues/3420
+    missing_codes = (
+        cohort_codes.lazy()
+        .join(codes.lazy().select("code"), how="anti", on="code")
+        .select(
+            [
+                pl.lit(chunk_ids[0]).cast(pl.Categorical).alias("PT_ID"),
+                "code",
+                pl.lit(None).cast(pl.Int16).alias("count"),
+            ]
+        )
+        .collect()
+    )
+    return pl.concat([codes, missing_codes])
+
+
+def _partition_code_file(
+    code_file: str, cohort_ids: pl.Series, chunks: list, directory: str
+) -> list:
+    """
+    Split the code file into one parquet file per chunk of subjects.
+
+    Parameters
+    ----------
+    code_file
+        Path to the ``PT_ID, code, index`` file.
+    cohort_ids
+        All subject ids in cohort.
+    chunks
+        Positions in ``cohort_ids`` of the subjects in each chunk.
+    directory
+        Directory to write the chunk files to.
+    Returns
+    -------
+    list
+        Paths of the chunk files, in chunk order.
+    """
+    chunk_sizes = [len(chunk) for chunk in chunks]
+    chunk_index = pl.DataFrame(
+        [
+            cohort_ids.take(np.concatenate(chunks)),
+            pl.Series("chunk", np.repeat(np.arange(len(chunks)), chunk_sizes)),
+        ]
+    )
+
     # https://github.com/pola-rs/polars/issues/3420
-    chunk_codes = codes.select("code").unique().collect()["code"]
-    missing_codes = cohort_codes.filter(~pl.col("code").is_in(chunk_codes))
-    missing_codes = missing_codes.with_columns(
+    # codes = codes.filter(pl.col("PT_ID").is_in(chunk_ids))
+    # workaround join
+    codes = (
+        _read_file(code_file, columns=["PT_ID", "code", "index"])
+        .with_column(pl.col("PT_ID").cast(pl.Categorical))
+        .join(chunk_index.lazy(), how="inner", on="PT_ID")
+        .with_column(pl.col("PT_ID").cast(pl.Utf8))
+        .sort("chunk")
+        .collect()
+    )
+    bounds = np.searchsorted(codes["chunk"].to_numpy(), np.arange(len(chunks) + 1))
+
+    chunk_files = []
+    for i in range(len(chunks)):
+        chunk_file = Path(directory) / f"chunk_{i}.parquet"
+        partition = codes.slice(bounds[i], bounds[i + 1] - bounds[i])
+        partition.drop("chunk").write_parquet(chunk_file)
+        chunk_files.append(chunk_file)
+    return chunk_files
+
+
+def _pivot_codes(codes: pl.DataFrame) -> pd.DataFrame:
+    """
+    Pivot long-form codes into the wide phenotype matrix. The matrix is filled
+    directly as a column-major int8 array, avoiding the dense float64 block that a
+    pivot + fillna would allocate.
+
+    Parameters
+    ----------
+    codes
+        pl.DataFrame of ``'PT_ID','code','count'``, with at most one row per id and
+        code. Null counts are treated as controls.
+    Returns
+    -------
+    pd.DataFrame
+        ``PT_ID`` followed by one column per code, rows and columns sorted.
+    """
+    codes = codes.select(
         [
-            chunk_ids[:1].alias("PT_ID").cast(pl.Categorical),
-            pl.lit(None).cast(pl.Int16).alias("count"),
+            pl.col("PT_ID").cast(pl.Utf8),
+            pl.col("code").cast(pl.Utf8),
+            pl.col("count").fill_null(0),
         ]
-    ).select(["PT_ID", "code", "count"])
-    return pl.concat([codes, missing_codes.lazy()])
+    ).to_pandas()
+    rows, ids = pd.factorize(codes["PT_ID"], sort=True)
+    cols, phecodes = pd.factorize(codes["code"], sort=True)
+
+    matrix = np.zeros((len(ids), len(phecodes)), dtype=np.int8, order="F")
+    matrix[rows, cols] = codes["count"].to_numpy()
+
+    phenotypes = pd.DataFrame(matrix, columns=phecodes)
+    phenotypes.insert(0, "PT_ID", ids)
+    return phenotypes
+
+
+@lru_cache(maxsize=None)
+def _scan_phecode_map() -> pl.LazyFrame:
+    phemap = pl.scan_parquet(_RESOURCES / "phecode_map.parquet")  # PheWAS::phecode_map
+    return phemap.with_columns(
+        [
+            pl.col("code").cast(pl.Categorical),
+            pl.col("phecode").cast(pl.Categorical),
+        ]
+    )
+
+
+@lru_cache(maxsize=None)
+def _scan_rollup_map() -> pl.LazyFrame:
+    rollup_map = pl.scan_parquet(
+        _RESOURCES / "phecode_rollup_map.parquet"  # PheWAS::phecode_rollup_map
+    )
+    return rollup_map.with_columns(
+        [
+            pl.col("code").cast(pl.Categorical),
+            pl.col("phecode_unrolled").cast(pl.Categorical),
+        ]
+    )
+
+
+@lru_cache(maxsize=None)
+def _scan_exclusions() -> pl.LazyFrame:
+    exclusions = pl.scan_parquet(
+        _RESOURCES / "phecode_exclude.parquet"  # PheWAS::phecode_exclude
+    )
+    return exclusions.with_columns(
+        [
+            pl.col("code").cast(pl.Categorical),
+            pl.col("exclusion_criteria").cast(pl.Categorical),
+        ]
+    )
+
+
+@lru_cache(maxsize=None)
+def _scan_sex_restrictions() -> pl.LazyFrame:
+    sex_restrictions = pl.scan_parquet(
+        _RESOURCES / "sex_restriction.parquet"  # PheWAS::gender_restriction
+    )
+    return sex_restrictions.with_columns(
+        [
+            pl.col("code").cast(pl.Categorical),
+            pl.col("exclude_sex").cast(pl.Categorical),
+        ]
+    )
 
 
 def _read_file(filename: str, columns=None) -> pl.LazyFrame:
     path = Path(filename)
     if path.is_file():
         if path.suffix == ".csv":
-            df = pl.scan_csv(path, parse_dates=True)
+            # ``index`` is only used as a distinct key, no need to parse dates
+            df = pl.scan_csv(path)
         elif path.suffix == ".parquet":
             df = pl.scan_parquet(path)
         elif path.suffix in (".ipc", ".feather"):
@@ -468,18 +616,28 @@ def _read_file(filename: str, columns=None) -> pl.LazyFrame:
 def _pd_write_file(output: pd.DataFrame, filename: str, n_chunks: int = 1) -> None:
     path = Path(filename)
     if path.suffix == ".csv":
+        # polars' csv writer is multithreaded, pandas' isn't
+        output = pl.from_pandas(output)
         if n_chunks > 1:
-            output.to_csv(filename, index=False, mode="a", header=not path.is_file())
+            has_header = not path.is_file()
+            with open(path, "ab") as f:
+                output.write_csv(f, has_header=has_header)
         else:
-            output.to_csv(filename, index=False)
+            output.write_csv(path)
     elif path.suffix == ".parquet":
         if n_chunks > 1:
             raise NotImplementedError(
                 "Only .csv output is supported for low_memory mode"
             )
         output.to_parquet(filename, index=False)
+    elif path.suffix in (".ipc", ".feather"):
+        if n_chunks > 1:
+            raise NotImplementedError(
+                "Only .csv output is supported for low_memory mode"
+            )
+        pl.from_pandas(output).write_ipc(path, compression="zstd")
     else:
         raise ValueError(
-            f"Invalid output file extension {path.suffix} - .csv and .parquet are "
-            f"accepted"
+            f"Invalid output file extension {path.suffix} - .csv, .parquet, and "
+            f".feather/.ipc are accepted"
         )